@@ -0,0 +1,281 @@
+"""
+Stores database dumps as a series of deduplicated, compressed chunks, so
+consecutive backups only take the space of the data that changed.
+Uploaded and run by the backup tasks of the fabfile, only uses the standard
+library.
+
+Chunks end at line boundaries chosen by the content of the lines, so data
+inserted in the middle of a dump doesn't change the chunks after it. Dumps
+need to be uncompressed (eg: "pg_dump -Fc -Z0") for this to work.
+"""
+from __future__ import division, print_function, unicode_literals
+
+import argparse
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import time
+import zlib
+from datetime import datetime, timedelta
+
+MIN_CHUNK = 16 * 1024
+MAX_CHUNK = 4 * 1024 * 1024
+# A line ends a chunk when its checksum matches the mask (1 in 1024 lines)
+BOUNDARY_MASK = 0x3ff
+
+
+class Store(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.objects = os.path.join(path, "objects")
+        self.snapshots = os.path.join(path, "snapshots")
+        for folder in (self.objects, self.snapshots):
+            if not os.path.exists(folder):
+                os.makedirs(folder)
+
+    def object_path(self, digest):
+        return os.path.join(self.objects, digest[:2], digest)
+
+    def snapshot_path(self, snapshot_id):
+        return os.path.join(self.snapshots, "%s.json" % snapshot_id)
+
+    def write_atomic(self, path, data):
+        tmp_path = "%s.tmp" % path
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.rename(tmp_path, path)
+
+    def put_chunk(self, chunk):
+        """
+        Saves a chunk if it's not in the store yet. Returns its digest and the
+        amount of bytes written.
+        """
+        digest = hashlib.sha256(chunk).hexdigest()
+        path = self.object_path(digest)
+        if os.path.exists(path):
+            return digest, 0
+        folder = os.path.dirname(path)
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        data = zlib.compress(chunk, 1)
+        self.write_atomic(path, data)
+        return digest, len(data)
+
+    def get_chunk(self, digest):
+        """
+        Returns the contents of a chunk, checking their integrity.
+        """
+        with open(self.object_path(digest), "rb") as f:
+            chunk = zlib.decompress(f.read())
+        if hashlib.sha256(chunk).hexdigest() != digest:
+            raise ValueError("Chunk %s is corrupted" % digest)
+        return chunk
+
+    def snapshot_ids(self):
+        return sorted(name[:-5] for name in os.listdir(self.snapshots)
+                      if name.endswith(".json"))
+
+    def load(self, snapshot_id):
+        ids = self.snapshot_ids()
+        if snapshot_id == "latest" and ids:
+            snapshot_id = ids[-1]
+        if snapshot_id not in ids:
+            raise KeyError("Backup %s doesn't exist" % snapshot_id)
+        with open(self.snapshot_path(snapshot_id), "r") as f:
+            return json.load(f)
+
+    def new_id(self):
+        snapshot_id = base_id = datetime.now().strftime("%Y%m%d-%H%M%S")
+        suffix = 1
+        while os.path.exists(self.snapshot_path(snapshot_id)):
+            snapshot_id = "%s-%s" % (base_id, suffix)
+            suffix += 1
+        return snapshot_id
+
+
+def chunks(stream):
+    """
+    Splits a stream of bytes into content-defined chunks.
+    """
+    chunk, size = [], 0
+    while True:
+        line = stream.readline(MAX_CHUNK)
+        if not line:
+            break
+        chunk.append(line)
+        size += len(line)
+        if size >= MAX_CHUNK or (size >= MIN_CHUNK and
+                                 not zlib.crc32(line) & BOUNDARY_MASK):
+            yield b"".join(chunk)
+            chunk, size = [], 0
+    if chunk:
+        yield b"".join(chunk)
+
+
+def store(args):
+    """
+    Runs the dump command and stores its output as a new backup.
+    """
+    repo = Store(args.store)
+    started = time.time()
+    dump = subprocess.Popen(args.command, stdout=subprocess.PIPE)
+    digests, total, written = [], hashlib.sha256(), 0
+    size = 0
+    for chunk in chunks(dump.stdout):
+        digest, chunk_written = repo.put_chunk(chunk)
+        digests.append([digest, len(chunk)])
+        total.update(chunk)
+        size += len(chunk)
+        written += chunk_written
+    if dump.wait() != 0:
+        print("The dump failed, the backup was not saved", file=sys.stderr)
+        return dump.returncode
+    snapshot = {
+        "id": repo.new_id(),
+        "label": args.label,
+        "created": datetime.now().isoformat(),
+        "size": size,
+        "written": written,
+        "sha256": total.hexdigest(),
+        "chunks": digests,
+    }
+    repo.write_atomic(repo.snapshot_path(snapshot["id"]),
+                      json.dumps(snapshot).encode("utf-8"))
+    if args.id_file:
+        with open(args.id_file, "w") as f:
+            f.write(snapshot["id"])
+    print("Saved backup %s: %.1f MB, %.1f MB new after compression, %.1fs" % (
+        snapshot["id"], size / 1e6, written / 1e6, time.time() - started))
+    return 0
+
+
+def restore(args):
+    """
+    Feeds a backup to the restore command.
+    """
+    repo = Store(args.store)
+    snapshot = repo.load(args.id)
+    print("Restoring backup %s" % snapshot["id"])
+    sys.stdout.flush()
+    target = subprocess.Popen(args.command, stdin=subprocess.PIPE)
+    try:
+        for digest, _ in snapshot["chunks"]:
+            target.stdin.write(repo.get_chunk(digest))
+    finally:
+        target.stdin.close()
+    return target.wait()
+
+
+def list_backups(args):
+    repo = Store(args.store)
+    print("%-20s %-12s %-20s %10s %10s" % (
+        "id", "label", "created", "size MB", "new MB"))
+    for snapshot_id in repo.snapshot_ids():
+        s = repo.load(snapshot_id)
+        print("%-20s %-12s %-20s %10.1f %10.1f" % (
+            s["id"], s["label"], s["created"][:19], s["size"] / 1e6,
+            s["written"] / 1e6))
+    return 0
+
+
+def verify(args):
+    """
+    Checks that every chunk of the backups is intact, and that they add up
+    to the original dumps.
+    """
+    repo = Store(args.store)
+    ids = [args.id] if args.id else repo.snapshot_ids()
+    failed = 0
+    for snapshot_id in ids:
+        snapshot = repo.load(snapshot_id)
+        total = hashlib.sha256()
+        try:
+            for digest, size in snapshot["chunks"]:
+                chunk = repo.get_chunk(digest)
+                if len(chunk) != size:
+                    raise ValueError("Chunk %s has the wrong size" % digest)
+                total.update(chunk)
+            if total.hexdigest() != snapshot["sha256"]:
+                raise ValueError("Checksum mismatch")
+        except (IOError, OSError, ValueError, zlib.error) as e:
+            failed += 1
+            print("%s: FAILED (%s)" % (snapshot["id"], e))
+        else:
+            print("%s: OK" % snapshot["id"])
+    return 1 if failed else 0
+
+
+def prune(args):
+    """
+    Deletes the backups outside of the retention policy, and the chunks no
+    longer used by any backup.
+    """
+    repo = Store(args.store)
+    snapshots = [repo.load(i) for i in repo.snapshot_ids()]
+    keep = set(s["id"] for s in snapshots[-args.keep_last:]
+               if args.keep_last)
+    keep.update(args.keep)
+    # The newest backup of each of the last days
+    since = (datetime.now() - timedelta(days=args.keep_daily)).isoformat()
+    days = {}
+    for s in snapshots:
+        if s["created"] >= since:
+            days[s["created"][:10]] = s["id"]
+    keep.update(days.values())
+    used = set()
+    for s in snapshots:
+        if s["id"] in keep:
+            used.update(digest for digest, _ in s["chunks"])
+        else:
+            os.remove(repo.snapshot_path(s["id"]))
+            print("Deleted backup %s" % s["id"])
+    freed = 0
+    for root, _, files in os.walk(repo.objects):
+        for name in files:
+            if name not in used:
+                path = os.path.join(root, name)
+                freed += os.path.getsize(path)
+                os.remove(path)
+    print("Kept %s backups, freed %.1f MB" % (len(keep), freed / 1e6))
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("store", help="Folder of the backup store")
+    commands = parser.add_subparsers(dest="action")
+    command = commands.add_parser("store", help="Save a new backup")
+    command.add_argument("--label", default="manual")
+    command.add_argument("--id-file", help="Write the new backup id here")
+    command.add_argument("command", nargs=argparse.REMAINDER,
+                         help="Command that writes the dump to stdout")
+    command.set_defaults(func=store)
+    command = commands.add_parser("restore", help="Restore a backup")
+    command.add_argument("id", help="Backup id or 'latest'")
+    command.add_argument("command", nargs=argparse.REMAINDER,
+                         help="Command that reads the dump from stdin")
+    command.set_defaults(func=restore)
+    command = commands.add_parser("list", help="List the backups")
+    command.set_defaults(func=list_backups)
+    command = commands.add_parser("verify", help="Check the backups")
+    command.add_argument("id", nargs="?")
+    command.set_defaults(func=verify)
+    command = commands.add_parser("prune", help="Delete old backups")
+    command.add_argument("--keep-last", type=int, default=10)
+    command.add_argument("--keep-daily", type=int, default=7)
+    command.add_argument("--keep", action="append", default=[],
+                         help="Id of a backup to keep regardless")
+    command.set_defaults(func=prune)
+    args = parser.parse_args()
+    try:
+        sys.exit(args.func(args))
+    except KeyError as e:
+        print(e.args[0], file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,163 @@
+"""
+Sends requests to a site from several concurrent clients during a fixed
+amount of time, and reports the throughput, latency and error rate.
+Uploaded and run by "fab loadtest", only uses the standard library.
+"""
+from __future__ import division, print_function, unicode_literals
+
+import argparse
+import json
+import socket
+import threading
+import time
+from datetime import datetime
+
+try:
+    from http.client import HTTPConnection, HTTPException
+    from urllib.parse import urlparse
+except ImportError:
+    from httplib import HTTPConnection, HTTPException
+    from urlparse import urlparse
+
+# Upper limits of the latency histogram buckets, in milliseconds
+BUCKETS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+
+def client(base, host, paths, deadline, timeout, results, lock):
+    """
+    Requests the paths in turn until the deadline, recording the latency and
+    status of each response.
+    """
+    latencies, statuses, errors = [], {}, 0
+    i = 0
+    try:
+        while time.time() < deadline:
+            path = paths[i % len(paths)]
+            i += 1
+            start = time.time()
+            # Sync gunicorn workers close the connection after each request
+            conn = HTTPConnection(base.hostname, base.port, timeout=timeout)
+            try:
+                conn.request("GET", base.path.rstrip("/") + path,
+                             headers={"Host": host or base.netloc})
+                response = conn.getresponse()
+                response.read()
+            except (socket.error, IOError, HTTPException):
+                errors += 1
+                continue
+            finally:
+                conn.close()
+            latencies.append((time.time() - start) * 1000)
+            statuses[response.status] = statuses.get(response.status, 0) + 1
+    finally:
+        # Keep the results gathered so far even if the client crashes
+        with lock:
+            results["latencies"].extend(latencies)
+            results["errors"] += errors
+            for status, count in statuses.items():
+                results["statuses"][status] = (
+                    results["statuses"].get(status, 0) + count)
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def summarize(results, duration):
+    """
+    Returns the report of a test from the raw results.
+    """
+    latencies = sorted(results["latencies"])
+    responses = len(latencies)
+    server_errors = sum(c for s, c in results["statuses"].items() if s >= 500)
+    total = responses + results["errors"]
+    histogram = []
+    for limit in BUCKETS + (None,):
+        count = len([l for l in latencies if limit is None or l <= limit])
+        histogram.append([limit, count - sum(c for _, c in histogram)])
+    return {
+        "requests": total,
+        "throughput": round(responses / duration, 2),
+        "error_rate": round((results["errors"] + server_errors) /
+                            float(total or 1), 4),
+        "connection_errors": results["errors"],
+        "statuses": dict((str(s), c) for s, c in results["statuses"].items()),
+        "latency_ms": {
+            "min": round(latencies[0], 1) if latencies else 0,
+            "mean": round(sum(latencies) / (responses or 1), 1),
+            "p50": round(percentile(latencies, .5), 1),
+            "p90": round(percentile(latencies, .9), 1),
+            "p99": round(percentile(latencies, .99), 1),
+            "max": round(latencies[-1], 1) if latencies else 0,
+        },
+        "histogram_ms": histogram,
+    }
+
+
+def print_report(report):
+    print("Requests: %(requests)s, %(throughput)s per second" % report)
+    print("Error rate: %.2f%%" % (report["error_rate"] * 100))
+    print("Statuses: %s" % ", ".join(
+        "%s: %s" % s for s in sorted(report["statuses"].items())))
+    print("Latency (ms): min %(min)s, mean %(mean)s, p50 %(p50)s, "
+          "p90 %(p90)s, p99 %(p99)s, max %(max)s" % report["latency_ms"])
+    responses = sum(c for _, c in report["histogram_ms"]) or 1
+    for limit, count in report["histogram_ms"]:
+        label = "<= %s" % limit if limit else "> %s" % BUCKETS[-1]
+        bar = "#" * int(round(40 * count / responses))
+        print("%10s ms %7s %s" % (label, count, bar))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("base_url", help="Eg: http://127.0.0.1:8000")
+    parser.add_argument("--host", help="Host header to send")
+    parser.add_argument("--path", action="append", default=[],
+                        help="Path to request, repeat it to add more")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--duration", type=float, default=30,
+                        help="Seconds to run the test")
+    parser.add_argument("--timeout", type=float, default=30)
+    parser.add_argument("--label", default="")
+    parser.add_argument("--meta", action="append", default=[],
+                        help="Extra KEY=VALUE to store with the results")
+    parser.add_argument("--output", help="Path to save the results as JSON")
+    args = parser.parse_args()
+
+    base = urlparse(args.base_url)
+    paths = args.path or ["/"]
+    results = {"latencies": [], "statuses": {}, "errors": 0}
+    lock = threading.Lock()
+    print("Testing %s with %s clients for %ss..." % (
+        args.base_url, args.concurrency, args.duration))
+    started = datetime.now()
+    start = time.time()
+    deadline = start + args.duration
+    threads = [threading.Thread(target=client, args=(
+        base, args.host, paths[i:] + paths[:i], deadline, args.timeout,
+        results, lock)) for i in range(args.concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    report = summarize(results, time.time() - start)
+    print_report(report)
+
+    if args.output:
+        report.update({
+            "label": args.label,
+            "started": started.isoformat(),
+            "duration": args.duration,
+            "concurrency": args.concurrency,
+            "paths": paths,
+            "meta": dict(m.split("=", 1) for m in args.meta),
+        })
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+        print("Results saved in %s" % args.output)
+
+
+if __name__ == "__main__":
+    main()
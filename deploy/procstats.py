@@ -0,0 +1,193 @@
+"""
+Samples the memory and CPU usage of a gunicorn master and its workers,
+reports memory growth and restarts, flags workers that look like they leak
+memory, and suggests values for the gunicorn settings. Uploaded and run by
+"fab stats", only uses the standard library.
+"""
+from __future__ import division, print_function, unicode_literals
+
+import argparse
+import os
+import time
+from collections import defaultdict
+
+CLOCK_TICKS = os.sysconf(str("SC_CLK_TCK"))
+
+
+def read_pid(path):
+    try:
+        with open(path) as f:
+            return int(f.read().strip())
+    except (IOError, ValueError):
+        return None
+
+
+def process_stat(pid):
+    """
+    Returns the parent pid and the CPU seconds used by a process.
+    """
+    with open("/proc/%s/stat" % pid) as f:
+        # The process name can have spaces, skip it
+        fields = f.read().rsplit(")", 1)[1].split()
+    return int(fields[1]), (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+
+
+def process_rss(pid):
+    """
+    Returns the resident memory of a process in MB.
+    """
+    with open("/proc/%s/status" % pid) as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+    return 0
+
+
+def sample(master):
+    """
+    Returns the time, rss and CPU of the master and each of its workers.
+    """
+    found = {}
+    for pid in os.listdir("/proc"):
+        if not pid.isdigit():
+            continue
+        try:
+            ppid, cpu = process_stat(pid)
+            if int(pid) == master or ppid == master:
+                found[int(pid)] = (time.time(), process_rss(pid), cpu)
+        except (IOError, OSError, IndexError):
+            # The process ended while we were reading it
+            continue
+    return found
+
+
+def slope(points):
+    """
+    Returns the slope (per minute) and r squared of a least squares fit.
+    """
+    n = len(points)
+    mean_x = sum(x for x, _ in points) / n
+    mean_y = sum(y for _, y in points) / n
+    sxx = sum((x - mean_x) ** 2 for x, _ in points)
+    syy = sum((y - mean_y) ** 2 for _, y in points)
+    sxy = sum((x - mean_x) * (y - mean_y) for x, y in points)
+    if not sxx:
+        return 0, 0
+    r2 = sxy ** 2 / (sxx * syy) if syy else 0
+    return sxy / sxx * 60, r2
+
+
+def count_requests(path, offset):
+    """
+    Returns the requests served by each worker since the given offset of the
+    access log, which starts every line with the pid, as "<1234>".
+    """
+    counts = defaultdict(int)
+    if not path or offset is None or not os.path.exists(path):
+        return None
+    with open(path, "rb") as f:
+        f.seek(offset)
+        for line in f:
+            pid = line.split(b" ", 1)[0].strip(b"<>")
+            if pid.isdigit():
+                counts[int(pid)] += 1
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("pidfile", help="Path to gunicorn's pid file")
+    parser.add_argument("--interval", type=float, default=5)
+    parser.add_argument("--samples", type=int, default=12)
+    parser.add_argument("--access-log", help="Access log with pids")
+    parser.add_argument("--memory-limit", type=float,
+                        help="Memory available for the site in MB")
+    parser.add_argument("--leak-threshold", type=float, default=.5,
+                        help="Memory growth in MB per minute considered a leak")
+    args = parser.parse_args()
+
+    offset = None
+    if args.access_log and os.path.exists(args.access_log):
+        offset = os.path.getsize(args.access_log)
+    masters, history = [], defaultdict(list)
+    start = time.time()
+    for i in range(args.samples):
+        master = read_pid(args.pidfile)
+        if master is None:
+            print("Gunicorn is not running")
+            return
+        if not masters or masters[-1] != master:
+            masters.append(master)
+        for pid, values in sample(master).items():
+            history[pid].append((i,) + values)
+        if i < args.samples - 1:
+            time.sleep(args.interval)
+    elapsed = (time.time() - start) / 60
+    requests = count_requests(args.access_log, offset)
+
+    last = args.samples - 1
+    workers = dict((p, h) for p, h in history.items() if p not in masters)
+    current = [p for p, h in workers.items() if h[-1][0] == last]
+    ended = [p for p, h in workers.items() if h[-1][0] < last]
+    started = [p for p, h in workers.items() if h[0][0] > 0]
+    master_rss = history[master][-1][2]
+
+    print("Sampled %s times every %ss" % (args.samples, args.interval))
+    print("Master %s: %.1f MB" % (master, master_rss))
+    if len(masters) > 1:
+        print("The master restarted %s times" % (len(masters) - 1))
+    print("Workers restarted: %s ended, %s started" % (
+        len(ended), len(started)))
+    print("")
+    print("%7s %9s %9s %10s %6s %9s" % (
+        "pid", "rss MB", "growth", "MB/min", "cpu%", "requests"))
+    leaks, peak, slopes = [], 0, []
+    for pid, points in sorted(workers.items()):
+        rss = [r for _, _, r, _ in points]
+        peak = max(peak, max(rss))
+        growth = rss[-1] - rss[0]
+        mb_per_min, r2 = (slope([(t, r) for _, t, r, _ in points])
+                          if len(points) > 2 else (0, 0))
+        seconds = points[-1][1] - points[0][1]
+        cpu = (points[-1][3] - points[0][3]) / seconds * 100 if seconds else 0
+        served = requests.get(pid, 0) if requests is not None else "-"
+        flag = ""
+        if mb_per_min > args.leak_threshold and r2 > .5:
+            leaks.append(pid)
+            slopes.append(mb_per_min)
+            flag = " <- possible leak"
+        print("%7s %9.1f %+9.1f %+10.2f %6.1f %9s%s" % (
+            pid, rss[-1], growth, mb_per_min, cpu, served, flag))
+    print("")
+
+    if not current:
+        return
+    avg_rss = sum(workers[p][-1][2] for p in current) / len(current)
+    if args.memory_limit:
+        # Leave some room for the master and other processes
+        available = args.memory_limit * .9 - master_rss
+        fit = max(int(available // peak), 1)
+        print("Suggested workers: %s (%s now, each one uses up to %.1f MB)" % (
+            min(fit, max(len(current), 1) + 1), len(current), peak))
+        if leaks:
+            headroom = available / len(current) - avg_rss
+            minutes = max(headroom / max(slopes), 0)
+            print("Leaking workers reach the memory limit in %.0f minutes" %
+                  minutes)
+            if requests is None:
+                print("Enable ACCESS_LOG to get a suggested max_requests")
+            elif not requests:
+                print("No requests were served while sampling")
+            else:
+                # Restart the workers halfway to the limit
+                rate = sum(requests.values()) / len(current) / elapsed
+                print("Suggested max_requests: %s" % max(
+                    int(rate * minutes / 2 // 100 * 100), 100))
+    elif leaks:
+        print("Set MEMORY_LIMIT to get suggested settings")
+    if not leaks:
+        print("No leaks detected, max_requests isn't needed")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,212 @@
+"""
+Generates the missing thumbnails of the images in MEDIA_ROOT, for every size
+used with the thumbnail template tag, so they aren't created while serving
+requests. Images referenced by the site's content are processed first.
+Uploaded and run by "fab thumbnails".
+"""
+from __future__ import division, print_function, unicode_literals
+
+import argparse
+import ast
+import os
+import re
+import resource
+import sys
+import time
+from multiprocessing import Pool
+
+import django
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".gif")
+THUMBNAIL_TAG = re.compile(r"{%\s*thumbnail\s+(.*?)\s*%}")
+# Arguments of the thumbnail tag after the image, width and height
+THUMBNAIL_OPTIONS = ("upscale", "quality", "left", "top", "padding",
+                     "padding_color")
+
+
+def template_dirs():
+    """
+    Returns the project and app template directories.
+    """
+    from django.conf import settings
+    dirs = list(getattr(settings, "TEMPLATE_DIRS", []))
+    for engine in getattr(settings, "TEMPLATES", []):
+        dirs.extend(engine.get("DIRS", []))
+    try:
+        from django.template.utils import get_app_template_dirs
+        dirs.extend(get_app_template_dirs("templates"))
+    except ImportError:
+        from django.template.loaders.app_directories import app_template_dirs
+        dirs.extend(app_template_dirs)
+    return dirs
+
+
+def parse_thumbnail_tag(args):
+    """
+    Returns the width, height and options of a thumbnail tag, or None if
+    they aren't all literals.
+    """
+    from django.utils.text import smart_split
+    bits = list(smart_split(args))
+    if "as" in bits:
+        bits = bits[:bits.index("as")]
+    if len(bits) < 3 or not (bits[1].isdigit() and bits[2].isdigit()):
+        return None
+    options = {}
+    for i, bit in enumerate(bits[3:]):
+        keyword = re.match(r"(\w+)=(.+)$", bit)
+        if keyword:
+            name, value = keyword.groups()
+        elif i < len(THUMBNAIL_OPTIONS):
+            name, value = THUMBNAIL_OPTIONS[i], bit
+        else:
+            return None
+        try:
+            options[name] = ast.literal_eval(value)
+        except (ValueError, SyntaxError):
+            # A template variable, the value is unknown
+            return None
+    return int(bits[1]), int(bits[2]), tuple(sorted(options.items()))
+
+
+def thumbnail_sizes():
+    """
+    Returns the sizes and options used with the thumbnail template tag.
+    """
+    sizes = set()
+    for templates in template_dirs():
+        for root, _, files in os.walk(templates):
+            for name in files:
+                if not name.endswith((".html", ".txt")):
+                    continue
+                with open(os.path.join(root, name), "rb") as f:
+                    content = f.read().decode("utf-8", "replace")
+                for args in THUMBNAIL_TAG.findall(content):
+                    size = parse_thumbnail_tag(args)
+                    if size:
+                        sizes.add(size)
+    return sizes
+
+
+def media_images():
+    """
+    Returns the paths of the images in MEDIA_ROOT, relative to it.
+    """
+    from mezzanine.conf import settings
+    images = []
+    for root, dirs, files in os.walk(settings.MEDIA_ROOT):
+        dirs[:] = [d for d in dirs if d != settings.THUMBNAILS_DIR_NAME]
+        for name in files:
+            if name.lower().endswith(IMAGE_EXTENSIONS):
+                path = os.path.join(root, name)
+                images.append(os.path.relpath(path, settings.MEDIA_ROOT))
+    return sorted(images)
+
+
+def referenced_images():
+    """
+    Returns the images referenced by file fields and rich text content,
+    relative to MEDIA_ROOT.
+    """
+    from django.apps import apps
+    from django.conf import settings
+    from django.db import DatabaseError
+    media_url = re.compile(re.escape(settings.MEDIA_URL) + r"([^\"'\s?)]+)")
+    images = set()
+    for model in apps.get_models():
+        fields = [f.name for f in model._meta.fields
+                  if re.search("File|Image|RichText", type(f).__name__)]
+        if not fields or not model._meta.managed:
+            continue
+        rows = model._base_manager.values_list(*fields).iterator()
+        try:
+            for values in rows:
+                for value in values:
+                    if not value:
+                        continue
+                    images.update(media_url.findall(value))
+                    if value.lower().endswith(IMAGE_EXTENSIONS):
+                        images.add(value)
+        except DatabaseError as e:
+            # Eg: the table of an app without migrations applied
+            print("Skipping %s: %s" % (model.__name__, e))
+    return images
+
+
+def init_worker(niceness):
+    os.nice(niceness)
+
+
+def generate(job):
+    """
+    Generates a thumbnail and returns the CPU seconds it took.
+    """
+    from mezzanine.core.templatetags.mezzanine_tags import thumbnail
+    image, width, height, options = job
+    start = resource.getrusage(resource.RUSAGE_SELF)
+    try:
+        thumbnail(image, width, height, **dict(options))
+        error = None
+    except Exception as e:
+        error = "%s (%sx%s %s): %s" % (image, width, height, options, e)
+    end = resource.getrusage(resource.RUSAGE_SELF)
+    cpu = (end.ru_utime - start.ru_utime) + (end.ru_stime - start.ru_stime)
+    return cpu, error
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--settings", required=True,
+                        help="Python path to the settings module")
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--budget", type=float, default=300,
+                        help="Maximum CPU seconds to use")
+    parser.add_argument("--size", action="append", default=[],
+                        help="Extra size to generate, as WIDTHxHEIGHT")
+    parser.add_argument("--nice", type=int, default=10)
+    args = parser.parse_args()
+
+    sys.path.insert(0, os.getcwd())
+    os.environ["DJANGO_SETTINGS_MODULE"] = args.settings
+    django.setup()
+
+    sizes = thumbnail_sizes()
+    for size in args.size:
+        width, height = size.lower().split("x")
+        sizes.add((int(width), int(height), ()))
+    referenced = referenced_images()
+    images = sorted(media_images(), key=lambda i: i not in referenced)
+    # The workers are forked, don't share the database connection with them
+    from django.db import connections
+    connections.close_all()
+    jobs = [(i,) + s for i in images for s in sorted(sizes, key=repr)]
+    print("%s images, %s sizes, %s thumbnails to check" % (
+        len(images), len(sizes), len(jobs)))
+    sys.stdout.flush()
+
+    cpu_used, errors, done = 0, 0, 0
+    start = time.time()
+    pool = Pool(args.workers, init_worker, (args.nice,))
+    try:
+        for cpu, error in pool.imap_unordered(generate, jobs, chunksize=4):
+            done += 1
+            cpu_used += cpu
+            if error:
+                errors += 1
+                print("Error: %s" % error)
+            if done % 50 == 0 or done == len(jobs):
+                print("%s/%s checked, %.1fs CPU, %.1fs elapsed" % (
+                    done, len(jobs), cpu_used, time.time() - start))
+                sys.stdout.flush()
+            if cpu_used > args.budget:
+                print("CPU budget of %ss exhausted, stopping" % args.budget)
+                break
+    finally:
+        pool.terminate()
+        pool.join()
+    print("Done: %s/%s checked, %s errors, %.1fs CPU" % (
+        done, len(jobs), errors, cpu_used))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,20 +1,26 @@
 from __future__ import print_function, unicode_literals
 from future.builtins import open
 
+import gzip
+import json
 import os
 import re
 import sys
 import tempfile
+import time
+from collections import OrderedDict
 from contextlib import contextmanager
 from functools import wraps
 from getpass import getpass, getuser
+from hashlib import md5, sha1
 from importlib import import_module
 from posixpath import join
 
 from mezzanine.utils.conf import real_project_name
 
-from fabric.api import abort, env, cd, get, prefix, run as _run, hide, task, local
-from fabric.context_managers import settings as fab_settings
+from fabric.api import (abort, env, cd, get, put, prefix, run as _run, hide,
+                        task, local)
+from fabric.context_managers import settings as fab_settings, shell_env
 from fabric.contrib.console import confirm
 from fabric.contrib.files import exists, upload_template
 from fabric.contrib.project import rsync_project
@@ -27,18 +33,110 @@ from fabric.colors import yellow, green, blue, red
 
 env.proj_app = real_project_name("project_name")
 
-conf = {}
-if sys.argv[0].split(os.sep)[-1] in ("fab", "fab-script.py"):
+# Tasks that only inspect the fabfile don't need the deploy settings
+LISTING_FLAGS = ("-l", "--list", "--shortlist", "-F", "--list-format",
+                 "-d", "--display", "-h", "--help", "-V", "--version")
+
+# Optional JSON file with the FABRIC dictionary, read instead of the settings
+CONF_PATH = os.environ.get("FABRIC_CONF", "fabric.json")
+
+# Cached copies of the FABRIC dictionary extracted from the settings modules,
+# kept outside of the projects since they hold passwords
+CONF_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache",
+                              "mezzanine-webf")
+
+
+def conf_cache_path():
+    """
+    Returns the path of the cached FABRIC dictionary of the current project.
+    """
+    key = sha1(os.path.abspath(os.getcwd()).encode("utf-8")).hexdigest()
+    return os.path.join(CONF_CACHE_DIR, "%s.json" % key[:16])
+
+
+def module_files(names):
+    """
+    Returns the source files of the given modules that are part of the
+    project.
+    """
+    root = os.path.abspath(os.getcwd()) + os.sep
+    files = set()
+    for name in names:
+        path = getattr(sys.modules.get(name), "__file__", None)
+        if not path:
+            continue
+        path = os.path.abspath(path)
+        if path.endswith((".pyc", ".pyo")) and os.path.exists(path[:-1]):
+            path = path[:-1]
+        if path.startswith(root):
+            files.add(path)
+    return files
+
+
+def file_mtimes(paths):
+    """
+    Returns the modification times of the given files, used to know when the
+    cached FABRIC dictionary is stale. Missing files are left out.
+    """
+    return dict((path, os.path.getmtime(path)) for path in paths
+                if os.path.exists(path))
+
+
+def load_conf():
+    """
+    Returns the FABRIC dictionary. Reads it from CONF_PATH if present, then
+    from the cache of a previous settings import if it's still fresh, and only
+    as a last resort imports the full Django settings module.
+    """
+    if os.path.exists(CONF_PATH):
+        with open(CONF_PATH, "r") as f:
+            return json.load(f)
+    cache_path = conf_cache_path()
+    if os.path.exists(cache_path):
+        with open(cache_path, "r") as f:
+            try:
+                cached = json.load(f)
+            except ValueError:
+                cached = {}
+        mtimes = cached.get("mtimes")
+        if mtimes and file_mtimes(mtimes) == mtimes:
+            return cached["conf"]
     # Ensure we import settings from the current dir
+    loaded = set(sys.modules)
+    settings = import_module("%s.settings" % env.proj_app)
+    conf = settings.FABRIC
+    # The settings module and the project modules it imported
+    names = set(sys.modules) - loaded | set([settings.__name__])
+    mtimes = file_mtimes(module_files(names))
+    if not mtimes:
+        # Nothing to tell when the cache is stale, don't keep one
+        return conf
     try:
-        conf = import_module("%s.settings" % env.proj_app).FABRIC
+        data = json.dumps({"mtimes": mtimes, "conf": conf})
+    except TypeError:
+        # Values that can't be serialized will be read from settings every time
+        return conf
+    if not os.path.exists(CONF_CACHE_DIR):
+        os.makedirs(CONF_CACHE_DIR, 0o700)
+    # The dictionary holds passwords, keep it readable only by the owner
+    fd = os.open(cache_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w") as f:
+        f.write(data)
+    return conf
+
+
+conf = {}
+if sys.argv[0].split(os.sep)[-1] in ("fab", "fab-script.py"):
+    if not [a for a in sys.argv[1:] if a.split("=")[0] in LISTING_FLAGS]:
         try:
-            conf["HOSTS"][0]
-        except (KeyError, ValueError):
-            raise ImportError
-    except (ImportError, AttributeError):
-        print("Aborting, no hosts defined.")
-        exit()
+            conf = load_conf()
+            try:
+                conf["HOSTS"][0]
+            except (KeyError, ValueError, IndexError):
+                raise ImportError
+        except (ImportError, AttributeError):
+            print("Aborting, no hosts defined.")
+            exit()
 
 env.db_pass = conf.get("DB_PASS", None)
 env.admin_pass = conf.get("ADMIN_PASS", None)
@@ -53,10 +151,18 @@ env.live_host = "%s.%s" % (env.live_subdomain, env.live_domain) if (
     env.live_subdomain) else env.live_domain
 
 env.proj_name = conf.get("PROJECT_NAME", env.proj_app)
+env.logs_path = "/home/%s/logs/user" % env.user
+env.backups_path = "/home/%s/backups/%s" % (env.user, env.proj_name)
+# Send the output of remote commands to a log file, set with "--set quiet"
+env.quiet = env.get("quiet", conf.get("QUIET", False))
 env.venv_home = "/home/%s/.virtualenvs" % env.user
 env.venv_path = join(env.venv_home, env.proj_name)
 env.proj_path = "/home/%s/webapps/%s" % (env.user, env.proj_name)
 env.manage = "%s/bin/python %s/manage.py" % (env.venv_path, env.proj_path)
+# Prebuilt virtualenvs, keyed by the requirements and Python version
+env.venv_cache = conf.get("VENV_CACHE", False)
+env.venv_cache_path = join(env.venv_home, ".cache")
+env.venv_cache_local = conf.get("VENV_CACHE_LOCAL_PATH", None)
 env.domains = conf.get("DOMAINS", env.live_host)
 env.domains_python = ", ".join(["'%s'" % s for s in env.domains])
 env.vcs_tools = ["git", "hg"]
@@ -64,8 +170,29 @@ env.deploy_tool = conf.get("DEPLOY_TOOL", "rsync")
 env.reqs_path = conf.get("REQUIREMENTS_PATH", None)
 env.locale = conf.get("LOCALE", "en_US.UTF-8")
 env.twitter_period = conf.get("TWITTER_PERIOD", None)
+env.loadtest_paths = conf.get("LOADTEST_PATHS", ["/"])
+env.backup_store = conf.get("BACKUP_STORE", True)
+env.backup_keep_last = conf.get("BACKUP_KEEP_LAST", 10)
+env.backup_keep_daily = conf.get("BACKUP_KEEP_DAILY", 7)
+env.thumbnails_auto = conf.get("THUMBNAILS_AUTO", True)
+env.thumbnail_workers = conf.get("THUMBNAIL_WORKERS", 2)
+env.thumbnail_cpu_budget = conf.get("THUMBNAIL_CPU_BUDGET", 300)
+env.thumbnail_sizes = conf.get("THUMBNAIL_SIZES", [])
 env.num_workers = conf.get("NUM_WORKERS",
                            "multiprocessing.cpu_count() * 2 + 1")
+env.max_requests = conf.get("MAX_REQUESTS", 0)
+env.max_requests_jitter = env.max_requests // 10
+env.use_access_log = "" if conf.get("ACCESS_LOG", False) else "#"
+env.access_log_format = '%(p)s %(h)s %(t)s "%(r)s" %(s)s %(L)s'
+env.memory_limit = conf.get("MEMORY_LIMIT", None)
+
+# Management commands run periodically by the scheduler process
+env.schedule = dict(conf.get("SCHEDULE", {}))
+if isinstance(env.twitter_period, int):
+    env.schedule.setdefault("poll_twitter", env.twitter_period)
+env.schedule_python = repr(env.schedule)
+env.scheduler_jitter = conf.get("SCHEDULER_JITTER", 30)
+env.use_scheduler = "" if env.schedule else "#"
 
 env.secret_key = conf.get("SECRET_KEY", "")
 env.nevercache_key = conf.get("NEVERCACHE_KEY", "")
@@ -78,6 +205,38 @@ if not (env.email_user and env.email_pass and env.default_email):
 else:
     env.use_email = ""
 
+# Cache tiers, see deploy/tiered_cache.py.template
+env.cache_middleware_seconds = conf.get("CACHE_MIDDLEWARE_SECONDS", 60)
+env.cache_local_timeout = conf.get("CACHE_LOCAL_TIMEOUT", 5)
+env.cache_local_max_entries = conf.get("CACHE_LOCAL_MAX_ENTRIES", 300)
+env.cache_fragments_timeout = conf.get("CACHE_FRAGMENTS_TIMEOUT", 300)
+# Sessions backed by the database survive a restart of memcached
+if conf.get("SESSIONS_CACHED_DB", False):
+    env.session_backend = "cached_db"
+else:
+    env.session_backend = "cache"
+
+# Database connections, optionally pooled by pgbouncer through a unix socket
+env.db_conn_max_age = conf.get("DB_CONN_MAX_AGE", 0)
+env.pgbouncer = conf.get("PGBOUNCER", False)
+env.pgbouncer_bin = conf.get("PGBOUNCER_BIN", "pgbouncer")
+env.pgbouncer_dir = "/home/%s/tmp/pgbouncer_%s" % (env.user, env.proj_name)
+# Each sync worker holds at most one server connection at a time, plus one
+# for the scheduler and management commands
+if isinstance(env.num_workers, int):
+    env.db_pool_size = conf.get("DB_POOL_SIZE", env.num_workers + 1)
+else:
+    env.db_pool_size = conf.get("DB_POOL_SIZE", 5)
+env.db_max_clients = env.db_pool_size * 4
+if env.pgbouncer:
+    env.db_host = env.pgbouncer_dir
+    env.db_port = "6432"
+    env.use_pgbouncer = ""
+else:
+    env.db_host = "127.0.0.1"
+    env.db_port = ""
+    env.use_pgbouncer = "#"
+
 # Remote git repos need to be "bare" and reside separated from the project
 if env.deploy_tool == "git":
     env.repo_path = "/home/%s/webapps/git_app/repos/%s.git" % (env.user, env.proj_name)
@@ -85,28 +244,64 @@ else:
     env.repo_path = env.proj_path
 
 
+# Packages installed in every virtualenv, besides the project requirements
+VENV_PACKAGES = ("gunicorn setproctitle psycopg2 django-compressor "
+                 "python-memcached")
+
+
 ##################
 # Template setup #
 ##################
 
 # Each template gets uploaded at deploy time, only if their
 # contents has changed, in which case, the reload command is
-# also run.
-
-templates = {
-    "supervisor": {
-        "local_path": "deploy/supervisor.conf.template",
-        "remote_path": "/home/%(user)s/etc/supervisor/conf.d/%(proj_name)s.conf",
-        "reload_command": "supervisorctl update gunicorn_%(proj_name)s",
-    },
-    "gunicorn": {
-        "local_path": "deploy/gunicorn.conf.py.template",
-        "remote_path": "%(proj_path)s/gunicorn.conf.py",
-    },
-    "settings": {
-        "local_path": "deploy/local_settings.py.template",
-        "remote_path": "%(proj_path)s/%(proj_app)s/local_settings.py",
-    },
+# also run. They're uploaded in order.
+
+templates = OrderedDict()
+
+templates["gunicorn"] = {
+    "local_path": "deploy/gunicorn.conf.py.template",
+    "remote_path": "%(proj_path)s/gunicorn.conf.py",
+}
+templates["settings"] = {
+    "local_path": "deploy/local_settings.py.template",
+    "remote_path": "%(proj_path)s/%(proj_app)s/local_settings.py",
+}
+templates["tiered_cache"] = {
+    "local_path": "deploy/tiered_cache.py.template",
+    "remote_path": "%(proj_path)s/%(proj_app)s/tiered_cache.py",
+}
+
+if env.pgbouncer:
+    # Reloads the config, or starts the pooler if it isn't running. On the
+    # first deploy supervisor doesn't know about it yet, and starts it later.
+    reload_pgbouncer = ("kill -HUP `cat %(pgbouncer_dir)s/pgbouncer.pid` "
+                        "2> /dev/null || "
+                        "supervisorctl start pgbouncer_%(proj_name)s || true")
+    templates["pgbouncer"] = {
+        "local_path": "deploy/pgbouncer.ini.template",
+        "remote_path": "%(proj_path)s/pgbouncer.ini",
+        "reload_command": reload_pgbouncer,
+    }
+    templates["pgbouncer_users"] = {
+        "local_path": "deploy/pgbouncer_users.txt.template",
+        "remote_path": "%(proj_path)s/pgbouncer_users.txt",
+        # Holds the database password
+        "mode": 0o600,
+        "reload_command": reload_pgbouncer,
+    }
+
+if env.schedule:
+    templates["scheduler"] = {
+        "local_path": "deploy/scheduler.py.template",
+        "remote_path": "%(proj_path)s/scheduler.py",
+    }
+
+# Last, so the files of the programs it starts are already there
+templates["supervisor"] = {
+    "local_path": "deploy/supervisor.conf.template",
+    "remote_path": "/home/%(user)s/etc/supervisor/conf.d/%(proj_name)s.conf",
+    "reload_command": "supervisorctl update",
 }
 
 
@@ -199,6 +394,14 @@ def update_changed_requirements():
     yield
     if old_reqs:
         new_reqs = get_reqs()
+        if env.venv_cache and old_reqs != new_reqs:
+            key = venv_key(new_reqs)
+            if not restore_venv(key):
+                # Installing over the old packages would leave stale ones in
+                # the artifact, build it from scratch instead
+                build_venv(key)
+                restore_venv(key)
+            return
         if old_reqs == new_reqs:
             # Unpinned requirements should always be checked.
             for req in new_reqs.split("\n"):
@@ -216,6 +419,100 @@ def update_changed_requirements():
         pip("-r %s/%s" % (env.proj_path, env.reqs_path))
 
 
+########################
+# Prebuilt virtualenvs #
+########################
+
+def venv_key(reqs):
+    """
+    Returns the key of the virtualenv artifact for the given requirements,
+    which also depends on the Python version in the server.
+    """
+    with hide("stdout"):
+        version = run("python2.7 -V 2>&1", show=False).strip()
+    lines = [version, VENV_PACKAGES]
+    lines += [l.strip() for l in reqs.splitlines() if l.strip()]
+    return sha1("\n".join(lines).encode("utf-8")).hexdigest()[:16]
+
+
+def restore_venv(key):
+    """
+    Replaces the project's virtualenv with a hard-linked copy of a prebuilt
+    artifact, uploading it first if it's only available locally. Returns
+    False if there's no artifact for the key.
+    """
+    artifact = join(env.venv_cache_path, key)
+    if not exists(artifact):
+        if not env.venv_cache_local:
+            return False
+        tarball = os.path.join(env.venv_cache_local, "%s.tar.gz" % key)
+        if not os.path.exists(tarball):
+            return False
+        _print(blue("Uploading virtualenv %s..." % key, bold=True))
+        run("mkdir -p %s" % env.venv_cache_path)
+        put(tarball, "%s.tar.gz" % artifact)
+        with cd(env.venv_cache_path):
+            run("tar -xzf {0}.tar.gz && rm {0}.tar.gz".format(key))
+    _print(blue("Restoring virtualenv %s..." % key, bold=True))
+    with hide("stdout"):
+        built_path = run("cat %s.path" % artifact, show=False).strip()
+    new_path = "%s.new" % env.venv_path
+    run("rm -rf %s" % new_path)
+    run("cp -al %s %s" % (artifact, new_path))
+    if built_path != env.venv_path:
+        # sed -i writes new files, so the artifact itself is left untouched
+        run("grep -rlIZ %s %s | xargs -0 -r sed -i 's|%s|%s|g'" % (
+            built_path, new_path, built_path, env.venv_path))
+    run("rm -rf %s" % env.venv_path)
+    run("mv %s %s" % (new_path, env.venv_path))
+    return True
+
+
+def store_venv(key, venv_path=None, move=False):
+    """
+    Saves a copy of the project's virtualenv (or the one in the given path)
+    as the artifact for the key, and downloads it if a local path for
+    artifacts is defined. With move, the virtualenv itself becomes the
+    artifact instead of a copy.
+    """
+    venv_path = venv_path or env.venv_path
+    artifact = join(env.venv_cache_path, key)
+    if exists(artifact):
+        return
+    _print(blue("Saving virtualenv %s..." % key, bold=True))
+    run("mkdir -p %s" % env.venv_cache_path)
+    run("%s %s %s.tmp" % ("mv" if move else "cp -a", venv_path, artifact))
+    run("echo %s > %s.path" % (venv_path, artifact))
+    run("mv %s.tmp %s" % (artifact, artifact))
+    if env.venv_cache_local:
+        if not os.path.exists(env.venv_cache_local):
+            os.makedirs(env.venv_cache_local)
+        with cd(env.venv_cache_path):
+            run("tar -czf {0}.tar.gz {0} {0}.path".format(key))
+        get("%s.tar.gz" % artifact,
+            os.path.join(env.venv_cache_local, "%s.tar.gz" % key))
+        run("rm %s.tar.gz" % artifact)
+
+
+def build_venv(key):
+    """
+    Installs the requirements in a new virtualenv next to the project's one,
+    and saves it as the artifact for the key.
+    """
+    _print(blue("Building virtualenv %s..." % key, bold=True))
+    build_path = "%s.build" % env.venv_path
+    run("rm -rf %s" % build_path)
+    run("virtualenv %s" % build_path)
+    # Make sure we don't inherit anything from the system's Python
+    run("touch %s/lib/python2.7/sitecustomize.py" % build_path)
+    with fab_settings(venv_path=build_path):
+        pip("-r %s/%s" % (env.proj_path, env.reqs_path), show=False)
+        pip(VENV_PACKAGES, show=False)
+    # Moved instead of copied, it's not needed here anymore
+    store_venv(key, build_path, move=True)
+    run("rm -rf %s" % build_path)
+
+
 ###########################################
 # Utils and wrappers for various commands #
 ###########################################
@@ -232,23 +529,106 @@ def print_command(command):
            red(" ->", bold=True))
 
 
-@task
+def verbose(func):
+    """
+    Turns quiet mode off for tasks whose output is the point of running them.
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        with fab_settings(quiet=False):
+            return func(*args, **kwargs)
+    return wrapper
+
+
 def run(command, show=True, *args, **kwargs):
     """
     Runs a shell comand on the remote server.
     """
+    if show and env.quiet:
+        return quiet_run(command, *args, **kwargs)
     if show:
         print_command(command)
     with hide("running"):
         return _run(command, *args, **kwargs)
 
 
+@task(name="run")
+@verbose
+def run_task(command):
+    """
+    Runs a shell comand on the remote server.
+    """
+    return run(command)
+
+
+def run_log():
+    """
+    Returns the remote log file that collects the output of this run.
+    """
+    if not env.get("run_log"):
+        env.run_log = "%s/%s_fab_%s.log" % (
+            env.logs_path, env.proj_name, time.strftime("%Y%m%d%H%M%S"))
+    return env.run_log
+
+
+def quiet_run(command, *args, **kwargs):
+    """
+    Runs a shell command on the remote server, sending its output to the run
+    log and printing only a progress line with its duration, or the label
+    keyword argument instead of the command. The log is downloaded and its
+    last lines are shown if the command fails.
+    """
+    label = kwargs.pop("label", None) or command
+    header = "$ %s" % label.replace("'", "'\\''")
+    log_path = run_log()
+    warn_only = env.warn_only
+    start = time.time()
+    with hide("running", "warnings"), fab_settings(warn_only=True):
+        result = _run("{ echo '%s'; %s ; } >> %s 2>&1" % (
+            header, command, log_path), *args, **kwargs)
+    duration = "(%.1fs)" % (time.time() - start)
+    if result.succeeded:
+        print(green("[ok] ", bold=True) + label + " " + duration)
+        return result
+    print(red("[failed] ", bold=True) + label + " " + duration)
+    fetch_run_log()
+    if not warn_only:
+        abort("Command failed: %s" % label)
+    return result
+
+
+def fetch_run_log(lines=20):
+    """
+    Downloads the compressed run log and shows its last lines.
+    """
+    log_path = run_log()
+    if not exists(log_path):
+        # The command failed before writing to it
+        print(yellow("Nothing was written to the run log", bold=True))
+        return
+    local_path = os.path.join(tempfile.gettempdir(),
+                              os.path.basename(log_path) + ".gz")
+    with hide("running", "stdout"):
+        _run("gzip -c %s > %s.gz" % (log_path, log_path))
+        get("%s.gz" % log_path, local_path)
+        _run("rm %s.gz" % log_path)
+    with gzip.open(local_path, "rb") as f:
+        output = f.read().decode("utf-8", "replace").splitlines()
+    _print("\n".join(output[-lines:]))
+    print(yellow("Full log saved in %s" % local_path, bold=True))
+
+
 def log_call(func):
     @wraps(func)
     def logged(*args, **kawrgs):
         header = "-" * len(func.__name__)
         _print(green("\n".join([header, func.__name__, header]), bold=True))
-        return func(*args, **kawrgs)
+        start = time.time()
+        result = func(*args, **kawrgs)
+        if env.quiet:
+            print(green("%s finished in %.1fs" % (
+                func.__name__, time.time() - start), bold=True))
+        return result
     return logged
 
 
@@ -256,28 +636,40 @@ def get_templates():
     """
     Returns each of the templates with env vars injected.
     """
-    injected = {}
+    injected = OrderedDict()
     for name, data in templates.items():
-        injected[name] = dict([(k, v % env) for k, v in data.items()])
+        # Only the strings are formatted, not the file modes
+        injected[name] = dict([(k, v if isinstance(v, int) else v % env)
+                               for k, v in data.items()])
     return injected
 
 
+def local_file(path):
+    """
+    Returns the path of a file shipped with the fabfile, looking for it next
+    to the fabfile if it's not in the current dir.
+    """
+    if not os.path.exists(path):
+        project_root = os.path.dirname(os.path.abspath(__file__))
+        path = os.path.join(project_root, path)
+    return path
+
+
 def upload_template_and_reload(name):
     """
     Uploads a template only if it has changed, and if so, reload the
     related service.
     """
     template = get_templates()[name]
-    local_path = template["local_path"]
-    if not os.path.exists(local_path):
-        project_root = os.path.dirname(os.path.abspath(__file__))
-        local_path = os.path.join(project_root, local_path)
+    local_path = local_file(template["local_path"])
     remote_path = template["remote_path"]
     reload_command = template.get("reload_command")
-    remote_data = ""
+    remote_hash = ""
     if exists(remote_path):
+        # Compare checksums instead of downloading the whole file
         with hide("stdout"):
-            remote_data = run("cat %s" % remote_path, show=False)
+            remote_hash = run("md5sum %s" % remote_path,
+                              show=False).split(" ")[0]
     with open(local_path, "r") as f:
         local_data = f.read()
         # Escape all non-string-formatting-placeholder occurrences of '%':
@@ -285,10 +677,10 @@ def upload_template_and_reload(name):
         if "%(db_pass)s" in local_data:
             env.db_pass = db_pass()
         local_data %= env
-    clean = lambda s: s.replace("\n", "").replace("\r", "").strip()
-    if clean(remote_data) == clean(local_data):
+    if remote_hash == md5(local_data.encode("utf-8")).hexdigest():
         return
-    upload_template(local_path, remote_path, env, use_sudo=False, backup=False)
+    upload_template(local_path, remote_path, env, use_sudo=False, backup=False,
+                    mode=template.get("mode"))
     if reload_command:
         run(reload_command)
 
@@ -312,6 +704,8 @@ def rsync_upload():
     """
     excludes = ["*.pyc", "*.pyo", "*.db", ".DS_Store", ".coverage",
                 "local_settings.py", "/static", "/.git", "/.hg"]
+    # These hold the FABRIC dictionary, passwords included
+    excludes.append(os.path.basename(CONF_PATH))
     local_dir = os.getcwd() + os.sep
     return rsync_project(remote_dir=env.proj_path, local_dir=local_dir,
                          exclude=excludes)
@@ -321,6 +715,14 @@ def vcs_upload():
     """
     Uploads the project with the selected VCS tool.
     """
+    if os.path.exists(CONF_PATH):
+        tracked = local({"git": "git ls-files %s",
+                         "hg": "hg status -mac %s"}[env.deploy_tool] %
+                        CONF_PATH, capture=True)
+        if tracked.strip():
+            abort("%s holds your passwords and is tracked by %s, please "
+                  "remove it from the repository." % (
+                      CONF_PATH, env.deploy_tool))
     if env.deploy_tool == "git":
         remote_path = "ssh://%s@%s%s" % (env.user, env.host_string,
                                          env.repo_path)
@@ -366,18 +768,59 @@ def pip(packages, show=True):
     if not exists(pip_tmp):
         run("mkdir -p %s" % pip_tmp)
     with virtualenv():
-        run("pip install -b %s %s" % (pip_tmp, packages), show=show)
+        # The output of pip is always sent to the run log in quiet mode
+        run("pip install -b %s %s" % (pip_tmp, packages),
+            show=show or env.quiet)
         run("rm -rf %s/*" % pip_tmp, show=show)  # Cleanup
 
 
+def backup_store(args):
+    """
+    Runs a command of the deduplicated backup store in the server.
+    """
+    script_path = "%s/backups.py" % env.backups_path
+    if not exists(env.backups_path):
+        run("mkdir -p %s" % env.backups_path)
+    with hide("running"):
+        put(local_file("deploy/backups.py"), script_path)
+    return run("python2.7 %s %s %s" % (script_path, env.backups_path, args))
+
+
+def store_backup(label, id_file=None):
+    """
+    Saves a backup of the remote database in the store, and deletes the
+    backups outside of the retention policy.
+    """
+    args = "store --label %s" % label
+    if id_file:
+        args += " --id-file %s" % id_file
+    # Uncompressed dumps are split in chunks that are compressed in the store
+    backup_store("%s pg_dump -U %s -Fc -Z0 %s" % (
+        args, env.proj_name, env.proj_name))
+    args = "prune --keep-last %s --keep-daily %s" % (
+        env.backup_keep_last, env.backup_keep_daily)
+    last_path = "%s/last.backup" % env.proj_path
+    if exists(last_path):
+        # Never delete the backup needed by rollback()
+        with hide("stdout"):
+            args += " --keep %s" % run("cat %s" % last_path, show=False)
+    backup_store(args)
+
+
 @task
-def backup(filename):
+def backup(filename=None, label="manual"):
     """
     Backs up the remote (production) database.
+    The backup is saved in the backup store with the given label, or in the
+    given file.
     """
     print(blue("Input the remote database password when prompted", bold=True))
-    return run("pg_dump -U %s -Fc %s > %s" % (
-        env.proj_name, env.proj_name, filename))
+    if filename:
+        return run("pg_dump -U %s -Fc %s > %s" % (
+            env.proj_name, env.proj_name, filename))
+    if not env.backup_store:
+        abort("BACKUP_STORE is disabled, please give a filename.")
+    store_backup(label)
 
 
 @task
@@ -391,15 +834,40 @@ def local_backup(filename):
 
 
 @task
-def restore(filename):
+def restore(filename=None, snapshot=None):
     """
     Restores the remote (production) database from a previous backup.
+    Pass the id of a backup in the backup store (or "latest") as snapshot to
+    restore it instead of a file.
     """
     print(blue("Input the remote database password when prompted", bold=True))
+    if snapshot:
+        return backup_store("restore %s pg_restore -U %s -c -d %s" % (
+            snapshot, env.proj_name, env.proj_name))
+    if not filename:
+        abort("Please give the filename or snapshot to restore.")
     return run("pg_restore -U %s -c -d %s %s" % (
         env.proj_name, env.proj_name, filename))
 
 
+@task
+@verbose
+def backups():
+    """
+    Lists the backups in the backup store.
+    """
+    backup_store("list")
+
+
+@task
+@verbose
+def verify_backups(snapshot=None):
+    """
+    Checks the integrity of the backups in the backup store.
+    """
+    backup_store("verify %s" % (snapshot or ""))
+
+
 @task
 def local_restore(filename):
     """
@@ -410,7 +878,6 @@ def local_restore(filename):
         env.proj_name, env.proj_name, filename))
 
 
-@task
 def python(code, show=True):
     """
     Runs Python code in the project's virtual environment, with Django loaded.
@@ -421,6 +888,8 @@ def python(code, show=True):
             "django.setup();" % env.proj_app
     full_code = 'python -c "%s%s"' % (setup, code.replace("`", "\\\`"))
     with project():
+        if show and env.quiet:
+            return quiet_run(full_code, label=code)
         if show:
             print_command(code)
         result = run(full_code, show=False)
@@ -435,7 +904,26 @@ def static():
                   "print(settings.STATIC_ROOT)", show=False).split("\n")[-1]
 
 
-@task
+def gunicorn_port():
+    """
+    Returns the port of the application, saved in the server on create().
+    """
+    with tempfile.TemporaryFile() as temp:
+        get("%s/app.port" % env.proj_path, temp)
+        temp.seek(0)
+        port = temp.read()
+    return port.strip()
+
+
+@task(name="python")
+@verbose
+def python_task(code):
+    """
+    Runs Python code in the project's virtual environment, with Django loaded.
+    """
+    return python(code)
+
+
 def manage(command):
     """
     Runs a Django management command.
@@ -443,6 +931,15 @@ def manage(command):
     return run("%s %s" % (env.manage, command))
 
 
+@task(name="manage")
+@verbose
+def manage_task(command):
+    """
+    Runs a Django management command.
+    """
+    return manage(command)
+
+
 #########################
 # Install and configure #
 #########################
@@ -495,6 +992,7 @@ def create():
     """
     # Set up virtualenv
     run("mkdir -p %s" % env.venv_home)
+    venv_cached = False
     with cd(env.venv_home):
         if exists(env.proj_name):
             if confirm("Virtualenv already exists in host server: %s"
@@ -502,9 +1000,17 @@ def create():
                 run("rm -rf %s" % env.proj_name)
             else:
                 abort("Aborted at user request")
-        run("virtualenv %s" % env.proj_name)
-        # Make sure we don't inherit anything from the system's Python
-        run("touch %s/lib/python2.7/sitecustomize.py" % env.proj_name)
+        if env.venv_cache:
+            reqs = ""
+            if env.reqs_path:
+                with open(env.reqs_path, "r") as f:
+                    reqs = f.read()
+            key = venv_key(reqs)
+            venv_cached = restore_venv(key)
+        if not venv_cached:
+            run("virtualenv %s" % env.proj_name)
+            # Make sure we don't inherit anything from the system's Python
+            run("touch %s/lib/python2.7/sitecustomize.py" % env.proj_name)
 
     # Create elements with the Webfaction API
     _print(blue("Creating database and website records in the Webfaction "
@@ -561,12 +1067,17 @@ def create():
 
     # Install project-specific requirements
     _print(blue("Installing project requirements...", bold=True))
-    upload_template_and_reload("settings")
+    # The pooler is started on the first deploy, connect directly until then
+    with fab_settings(db_host="127.0.0.1", db_port=""):
+        upload_template_and_reload("settings")
+    upload_template_and_reload("tiered_cache")
     with project():
-        if env.reqs_path:
-            pip("-r %s/%s" % (env.proj_path, env.reqs_path), show=False)
-        pip("gunicorn setproctitle psycopg2 "
-            "django-compressor python-memcached", show=False)
+        if not venv_cached:
+            if env.reqs_path:
+                pip("-r %s/%s" % (env.proj_path, env.reqs_path), show=False)
+            pip(VENV_PACKAGES, show=False)
+            if env.venv_cache:
+                store_venv(key)
     # Bootstrap the DB
         _print(blue("Initializing the database...", bold=True))
         manage("createdb --noinput --nodata")
@@ -619,14 +1130,19 @@ def remove():
     if db_user:
         del_webf_obj(srv, ssn, "db_user", env.proj_name, "postgresql")
     if isinstance(env.twitter_period, int):
-        srv.delete_cronjob(ssn, "*/%s * * * * %s poll_twitter" % (
-            env.twitter_period, env.manage))
+        delete_twitter_cronjob(srv, ssn)
 
     # Delete files/folders
+    if env.pgbouncer and exists(env.pgbouncer_dir):
+        run("rm -rf %s" % env.pgbouncer_dir)
     if exists(env.venv_path):
         run("rm -rf %s" % env.venv_path)
     if exists(env.repo_path):
         run("rm -rf %s" % env.repo_path)
+    if exists(env.backups_path):
+        if confirm("Would you like to delete the database backups too?",
+                   default=False):
+            run("rm -rf %s" % env.backups_path)
     for template in get_templates().values():
         remote_path = template["remote_path"]
         if exists(remote_path):
@@ -649,7 +1165,13 @@ def restart():
     """
     pid_path = "%s/gunicorn.pid" % env.proj_path
     if exists(pid_path):
+        if env.pgbouncer:
+            # Also brings the pooler back if it died
+            run("supervisorctl restart pgbouncer_%s" % env.proj_name)
         run("supervisorctl restart gunicorn_%s" % env.proj_name)
+        if env.schedule:
+            # Load the new code in the scheduler too
+            run("supervisorctl restart scheduler_%s" % env.proj_name)
     else:
         run("supervisorctl update")
 
@@ -673,8 +1195,11 @@ def deploy():
 
     # Backup current version of the project
     _print(blue("Backing up static files and database...", bold=True))
-    with cd(env.proj_path):
-        backup("last.db")
+    if env.backup_store:
+        store_backup("deploy", id_file="%s/last.backup" % env.proj_path)
+    else:
+        with cd(env.proj_path):
+            backup("last.db")
     if env.deploy_tool in env.vcs_tools:
         with cd(env.repo_path):
             if env.deploy_tool == "git":
@@ -688,7 +1213,8 @@ def deploy():
                     static_dir)
     else:
         with cd(join(env.proj_path, "..")):
-            excludes = ["*.pyc", "*.pio", "*.thumbnails"]
+            excludes = ["*.pyc", "*.pio", "*.thumbnails",
+                        os.path.basename(CONF_PATH)]
             exclude_arg = " ".join("--exclude='%s'" % e for e in excludes)
             run("tar -cf {0}.tar {1} {0}".format(env.proj_name, exclude_arg))
 
@@ -708,11 +1234,9 @@ def deploy():
     # Upload templated config files
     _print(blue("Uploading configuration files...", bold=True))
     # Get the application port we saved on create() into the context
-    with tempfile.TemporaryFile() as temp:
-        get("%s/app.port" % env.proj_path, temp)
-        temp.seek(0)
-        port = temp.read()
-        env.gunicorn_port = port.strip()
+    env.gunicorn_port = gunicorn_port()
+    if env.pgbouncer:
+        run("mkdir -p %s" % env.pgbouncer_dir)
     for name in get_templates():
         upload_template_and_reload(name)
     restart()
@@ -744,9 +1268,17 @@ def rollback():
             with cd(env.proj_path.rsplit("/", 1)[0]):
                 run("rm -rf %s" % env.proj_name)
                 run("tar -xf %s.tar" % env.proj_name)
-    with cd(env.proj_path):
-        restore("last.db")
+    last_path = "%s/last.backup" % env.proj_path
+    if env.backup_store and exists(last_path):
+        with hide("stdout"):
+            snapshot = run("cat %s" % last_path, show=False).strip()
+        restore(snapshot=snapshot)
+    else:
+        with cd(env.proj_path):
+            restore("last.db")
     restart()
+    if env.thumbnails_auto:
+        thumbnails()
 
 
 @task
@@ -778,6 +1310,7 @@ def pulldb():
     backup("%s_production.sql" % env.proj_name)
     local("scp {0}@{1}:/home/{0}/{2}_production.sql .".format(
         env.user, env.host_string, env.proj_name))
+    run("rm %s_production.sql" % env.proj_name)
     with fab_settings(warn_only=True):
         # This last part can output some errors, but the restoration goes well
         local_restore("%s_production.sql" % env.proj_name)
@@ -796,9 +1329,120 @@ def pushdb():
     local_backup("%s_development.sql" % env.proj_name)
     local("scp {2}_development.sql {0}@{1}:/home/{0}/".format(
         env.user, env.host_string, env.proj_name))
+    if env.backup_store:
+        # Keep a way back to the production data
+        store_backup("pushdb")
     with fab_settings(warn_only=True):
         # This last part can output some errors, but the restoration goes well
         restore("%s_development.sql" % env.proj_name)
+    run("rm %s_development.sql" % env.proj_name)
+
+
+@task
+@log_call
+@verbose
+def db_stats(seconds=10):
+    """
+    Reports how often the site opens new database connections.
+    Samples the project's connections to Postgres a few times per second
+    during the given amount of seconds.
+    """
+    samples = int(seconds) * 5
+    sql = ("SELECT pid::text, 0 FROM pg_stat_activity "
+           "WHERE datname = current_database() AND usename = current_user "
+           "AND pid <> pg_backend_pid() UNION ALL "
+           "SELECT 'xact', xact_commit + xact_rollback FROM pg_stat_database "
+           "WHERE datname = current_database()")
+    psql = "psql -U %s -h 127.0.0.1 -At" % env.proj_name
+    _print(blue("Sampling connections for %s seconds..." % seconds, bold=True))
+    with shell_env(PGPASSWORD=db_pass()), hide("stdout"):
+        output = run('for i in $(seq %s); do %s -c "%s" %s; sleep 0.2; done' %
+                     (samples, psql, sql, env.proj_name), show=False)
+    pids, xacts, current = [], [], set()
+    for line in output.splitlines():
+        key, _, value = line.strip().partition("|")
+        if key == "xact":
+            pids.append(current)
+            xacts.append(int(value))
+            current = set()
+        elif key:
+            current.add(key)
+    if not pids:
+        abort("Couldn't read the database statistics.")
+    opened = set().union(*pids) - pids[0]
+    # Each sample is a transaction of its own, don't count the ones between
+    # the first and the last
+    transactions = xacts[-1] - xacts[0] - (len(xacts) - 1)
+    print("Connections open now: %s" % len(pids[-1]))
+    print("New connections per second: %.2f (at least)" % (
+        len(opened) / float(seconds)))
+    print("Transactions per second: %.2f" % (
+        max(transactions, 0) / float(seconds)))
+    if env.pgbouncer:
+        psql = "psql -U %s -h %s -p %s" % (
+            env.proj_name, env.pgbouncer_dir, env.db_port)
+        with shell_env(PGPASSWORD=db_pass()):
+            run('%s -c "SHOW POOLS;" pgbouncer' % psql)
+            run('%s -c "SHOW STATS;" pgbouncer' % psql)
+
+
+@task
+@log_call
+@verbose
+def stats(interval=5, samples=12):
+    """
+    Samples the memory and CPU usage of the gunicorn workers.
+    Reports their memory growth and restarts, flags workers that may be
+    leaking memory, and suggests values for NUM_WORKERS and MAX_REQUESTS.
+    """
+    script_path = "%s/procstats.py" % env.proj_path
+    put(local_file("deploy/procstats.py"), script_path)
+    args = "--interval %s --samples %s" % (interval, samples)
+    if env.use_access_log == "":
+        args += " --access-log %s/%s_access.log" % (
+            env.logs_path, env.proj_name)
+    if env.memory_limit:
+        args += " --memory-limit %s" % env.memory_limit
+    _print(blue("Sampling gunicorn for %g seconds..." % (
+        float(interval) * (int(samples) - 1)), bold=True))
+    run("%s/bin/python %s %s/gunicorn.pid %s" % (
+        env.venv_path, script_path, env.proj_path, args))
+
+
+@task
+@log_call
+@verbose
+def loadtest(concurrency=4, duration=30, paths=None, label="", url=None):
+    """
+    Measures the throughput and latency of the site.
+    Sends requests to gunicorn from the server itself during the given amount
+    of seconds and saves the results in the logs folder. Separate the paths
+    to request with semicolons. Pass a url to test a local server instead.
+    """
+    paths = paths.split(";") if paths else env.loadtest_paths
+    name = "%s_loadtest_%s.json" % (
+        env.proj_name, time.strftime("%Y%m%d%H%M%S"))
+    meta = {"label": label, "num_workers": env.num_workers,
+            "cache_middleware_seconds": env.cache_middleware_seconds}
+    args = "--concurrency %s --duration %s --label '%s'" % (
+        concurrency, duration, label)
+    args += "".join(" --path '%s'" % p for p in paths)
+    args += "".join(" --meta '%s=%s'" % m for m in sorted(meta.items()))
+    if url:
+        output = os.path.join(tempfile.gettempdir(), name)
+        local("python %s %s %s --output %s" % (
+            local_file("deploy/loadtest.py"), url, args, output))
+        return
+    script_path = "%s/loadtest.py" % env.proj_path
+    put(local_file("deploy/loadtest.py"), script_path)
+    if env.deploy_tool == "git":
+        with hide("stdout"):
+            args += " --meta 'commit=%s'" % run(
+                "git --git-dir=%s rev-parse HEAD" % env.repo_path,
+                show=False).strip()
+    run("%s/bin/python %s http://127.0.0.1:%s --host %s %s --output %s/%s" % (
+        env.venv_path, script_path, gunicorn_port(), env.live_host, args,
+        env.logs_path, name))
 
 
 @task
@@ -817,6 +1461,26 @@ def pushmedia():
     Upload the local media files into the remote MEDIA_ROOT.
     """
     cpmedia(upload=True)
+    if env.thumbnails_auto:
+        thumbnails()
+
+
+@task
+@log_call
+def thumbnails(workers=None, budget=None):
+    """
+    Generates the missing thumbnails of the remote media files.
+    Uses the sizes found in the thumbnail template tags, with a pool of
+    low priority processes that stop after using the given CPU seconds.
+    """
+    workers = workers or env.thumbnail_workers
+    budget = budget or env.thumbnail_cpu_budget
+    script_path = "%s/thumbnails.py" % env.proj_path
+    put(local_file("deploy/thumbnails.py"), script_path)
+    sizes = "".join(" --size %sx%s" % tuple(s) for s in env.thumbnail_sizes)
+    with project():
+        run("python %s --settings %s.settings --workers %s --budget %s%s" % (
+            script_path, env.proj_app, workers, budget, sizes))
 
 
 @task
@@ -834,19 +1498,56 @@ def setup_email():
     srv.create_email(ssn, env.default_email, env.email_user)
 
 
+def delete_twitter_cronjob(srv, ssn):
+    """
+    Removes the cronjob used to poll Twitter before the scheduler existed.
+    """
+    import xmlrpclib
+    try:
+        srv.delete_cronjob(ssn, "*/%s * * * * %s poll_twitter" % (
+            env.twitter_period, env.manage))
+    except xmlrpclib.Fault:
+        pass
+
+
 @task
 @log_call
 def setup_twitter():
     """
-    Setup a cron job to poll Twitter periodically.
+    Setup the scheduler to poll Twitter periodically.
     """
     if isinstance(env.twitter_period, int):
         srv, ssn, acn = get_webf_session()
-        srv.create_cronjob(ssn, "*/%s * * * * %s poll_twitter" % (
-            env.twitter_period, env.manage))
+        delete_twitter_cronjob(srv, ssn)
         manage("poll_twitter")
-        print("New cronjob. Twitter will be polled every %s minutes. "
+        upload_template_and_reload("scheduler")
+        upload_template_and_reload("supervisor")
+        # Gunicorn doesn't need a restart, only the scheduler
+        run("supervisorctl restart scheduler_%s" % env.proj_name)
+        print("Twitter will be polled every %s minutes. "
               "Please make sure you have configured your Twitter credentials "
               "in your site settings." % env.twitter_period)
     else:
         abort("TWITTER_PERIOD not set correctly in deployment settings.")
+
+
+@task
+def schedule_stats():
+    """
+    Shows the run metrics of the jobs in the scheduler.
+    """
+    if not env.schedule:
+        abort("Please define SCHEDULE or TWITTER_PERIOD in the FABRIC "
+              "dictionary first.")
+    stats_path = "%s/scheduler.json" % env.proj_path
+    if not exists(stats_path):
+        abort("The scheduler hasn't completed any jobs yet.")
+    with hide("stdout"):
+        stats = json.loads(run("cat %s" % stats_path, show=False))
+    for command, job in sorted(stats.items()):
+        _print(blue(command, bold=True))
+        print("Runs: %(runs)s, failures: %(failures)s, "
+              "overruns: %(overruns)s" % job)
+        print("Last run: %(last_start)s (%(last_duration)ss)" % job)
+        print("Duration: %(avg_duration)ss average, "
+              "%(max_duration)ss max" % job)
@@ -17,11 +17,36 @@ FABRIC = {
     "LIVE_DOMAIN": "example.com",  # Domain to associate the app with
     "LIVE_SUBDOMAIN": "www",  # Subdomain to associate the app with (optional)
     "REQUIREMENTS_PATH": "requirements.txt",  # Project's pip requirements
+    # "VENV_CACHE": False,  # Reuse virtualenvs built for the same requirements
+    # "VENV_CACHE_LOCAL_PATH": "",  # Local folder to keep a copy of them
     "LOCALE": "en_US.UTF-8",  # Should end with ".UTF-8"
     "NUM_WORKERS": 2,  # Limit the amount of workers for gunicorn
+    # "MAX_REQUESTS": 0,  # Restart each worker after this many requests
+    # "ACCESS_LOG": False,  # Log requests, needed by "fab stats" to count them
+    # "MEMORY_LIMIT": 512,  # MB of memory available for the site
+    # "QUIET": False,  # Send remote output to a log file in the server
+    # "LOADTEST_PATHS": ["/", "/blog/"],  # Paths requested by "fab loadtest"
     # "DB_PASS": "",  # Live database password
+    # "BACKUP_STORE": True,  # Keep deduplicated database backups in ~/backups
+    # "BACKUP_KEEP_LAST": 10,  # Amount of recent backups to keep
+    # "BACKUP_KEEP_DAILY": 7,  # Days to keep one backup per day for
+    # "DB_CONN_MAX_AGE": 60,  # Seconds to keep database connections open
+    # "PGBOUNCER": False,  # Pool database connections with pgbouncer
+    # "PGBOUNCER_BIN": "pgbouncer",  # Path to pgbouncer in the server
+    # "DB_POOL_SIZE": 3,  # Server connections, defaults to NUM_WORKERS + 1
     # "ADMIN_PASS": "",  # Live admin user password
+    # "CACHE_MIDDLEWARE_SECONDS": 60,  # Lifetime of cached pages
+    # "CACHE_LOCAL_TIMEOUT": 5,  # Seconds values stay in each worker's memory
+    # "CACHE_LOCAL_MAX_ENTRIES": 300,  # Values kept in each worker's memory
+    # "CACHE_FRAGMENTS_TIMEOUT": 300,  # Lifetime of cached template fragments
+    # "SESSIONS_CACHED_DB": False,  # Also store sessions in the database
     # "TWITTER_PERIOD": None,  # Minutes
+    # "SCHEDULE": {"clearsessions": 1440},  # Management commands and minutes
+    # "SCHEDULER_JITTER": 30,  # Max random delay of scheduled jobs (seconds)
+    # "THUMBNAILS_AUTO": True,  # Generate thumbnails after media changes
+    # "THUMBNAIL_WORKERS": 2,  # Processes used to generate thumbnails
+    # "THUMBNAIL_CPU_BUDGET": 300,  # Max CPU seconds used on each run
+    # "THUMBNAIL_SIZES": [[100, 100]],  # Sizes not found in the templates
     "SECRET_KEY": SECRET_KEY,
     "NEVERCACHE_KEY": NEVERCACHE_KEY,
 